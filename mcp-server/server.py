@@ -1,18 +1,33 @@
 import asyncio
-import json
+import functools
 import logging
+import logging.handlers
 import os
+import queue
+import signal
 import sys
-import threading
-import time
 
-from aiohttp import web
+import orjson
+import uvicorn
 from mcp.server.fastmcp import FastMCP
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
 
 from svg_state import SvgCanvas
 
-# Log to stderr only — stdout is reserved for MCP stdio transport
-logging.basicConfig(level=logging.INFO, stream=sys.stderr, format="%(asctime)s %(message)s")
+# Log to stderr only — stdout is reserved for MCP stdio transport. Records are queued and
+# written by log_listener's thread, so tool calls never block on a slow terminal.
+_log_queue: queue.Queue = queue.Queue(-1)
+_stderr_handler = logging.StreamHandler(sys.stderr)
+_stderr_handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+log_listener = logging.handlers.QueueListener(_log_queue, _stderr_handler)
+_queue_handler = logging.handlers.QueueHandler(_log_queue)
+_queue_handler.setFormatter(logging.Formatter("%(message)s"))  # only merge args; _stderr_handler adds the rest
+logging.basicConfig(level=logging.INFO, handlers=[_queue_handler])
 log = logging.getLogger("svg-mcp")
 
 canvas = SvgCanvas()
@@ -20,22 +35,57 @@ mcp_port = int(os.environ.get("MCP_PORT", "8766"))
 mcp = FastMCP("svg-editor", host="0.0.0.0", port=mcp_port)
 
 
+def _dumps(obj) -> str:
+    """Serialize to a JSON string — MCP tools must return str, not bytes."""
+    return orjson.dumps(obj).decode()
+
+
+def _parse_attrs(attrs: str) -> dict[str, str]:
+    """Parse a tool's attrs JSON object; non-string values (e.g. 100) become their JSON text."""
+    parsed = orjson.loads(attrs)
+    if not isinstance(parsed, dict):
+        raise ValueError("expected a JSON object of attribute names to values")
+    for k, v in parsed.items():
+        if not isinstance(v, str):
+            parsed[k] = orjson.dumps(v).decode()
+    return parsed
+
+
+class ORJSONResponse(JSONResponse):
+    """Starlette JSON response encoded with orjson instead of the stdlib dumper."""
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content)
+
+
+def _cached_per_version(fn):
+    """Reuse a read-only tool's result until canvas.version changes."""
+    @functools.wraps(fn)
+    def wrapper(**kwargs):
+        key = (fn.__name__, *sorted(kwargs.items()))
+        hit = canvas.cached_tool_result(key)
+        if hit is not None:
+            return hit
+        version = canvas.current_version()
+        result = fn(**kwargs)
+        canvas.cache_tool_result(key, version, result)
+        return result
+    return wrapper
+
+
 # ── MCP Tools ──────────────────────────────────────────────
 
 @mcp.tool()
-def list_elements() -> str:
-    """List all SVG elements on the canvas with their IDs, attributes, and layer."""
-    elements = [
-        {
-            "id": el.id,
-            "tag": el.tag,
-            "attrs": el.attrs,
-            "text_content": el.text_content,
-            "layer": el.attrs.get("data-layer", "CUT_OUTSIDE"),
-        }
-        for el in canvas.list_elements()
-    ]
-    return json.dumps({
+@_cached_per_version
+def list_elements(layer: str = "") -> str:
+    """List all SVG elements on the canvas with their IDs, attributes, and layer.
+
+    Args:
+        layer: Only list elements on this layer (default: all layers).
+    """
+    # orjson serializes the SvgElement dataclasses directly — no per-row dicts
+    elements = canvas.elements_in_layer(layer) if layer else canvas.list_elements()
+    return _dumps({
         "canvas": {"width": canvas.width, "height": canvas.height},
         "elements": elements,
     })
@@ -52,12 +102,11 @@ def add_element(tag: str, attrs: str, text_content: str = "", layer: str = "CUT_
         layer: Layer to assign the element to (default: CUT_OUTSIDE). Options: CUT_OUTSIDE, CUT_INSIDE, ENGRAVE, NOTES.
     """
     try:
-        parsed = json.loads(attrs)
-    except json.JSONDecodeError as e:
-        return json.dumps({"error": f"Invalid JSON in attrs: {e}"})
-    parsed["data-layer"] = layer
-    el = canvas.add_element(tag, parsed, text_content)
-    return json.dumps({"id": el.id, "tag": el.tag, "attrs": el.attrs, "layer": layer})
+        parsed = _parse_attrs(attrs)
+    except ValueError as e:  # includes orjson.JSONDecodeError
+        return _dumps({"error": f"Invalid JSON in attrs: {e}"})
+    el = canvas.add_element(tag, parsed, text_content, layer)
+    return _dumps({"id": el.id, "tag": el.tag, "attrs": el.attrs, "layer": el.layer})
 
 
 @mcp.tool()
@@ -69,13 +118,13 @@ def update_element(element_id: str, attrs: str) -> str:
         attrs: JSON string of attributes to set/update.
     """
     try:
-        parsed = json.loads(attrs)
-    except json.JSONDecodeError as e:
-        return json.dumps({"error": f"Invalid JSON in attrs: {e}"})
+        parsed = _parse_attrs(attrs)
+    except ValueError as e:  # includes orjson.JSONDecodeError
+        return _dumps({"error": f"Invalid JSON in attrs: {e}"})
     el = canvas.update_element(element_id, parsed)
     if not el:
-        return json.dumps({"error": f"Element '{element_id}' not found"})
-    return json.dumps({"id": el.id, "tag": el.tag, "attrs": el.attrs})
+        return _dumps({"error": f"Element '{element_id}' not found"})
+    return _dumps({"id": el.id, "tag": el.tag, "attrs": el.attrs})
 
 
 @mcp.tool()
@@ -87,11 +136,12 @@ def remove_element(element_id: str) -> str:
     """
     ok = canvas.remove_element(element_id)
     if not ok:
-        return json.dumps({"error": f"Element '{element_id}' not found"})
-    return json.dumps({"removed": True, "id": element_id})
+        return _dumps({"error": f"Element '{element_id}' not found"})
+    return _dumps({"removed": True, "id": element_id})
 
 
 @mcp.tool()
+@_cached_per_version
 def get_svg() -> str:
     """Get the full SVG markup of the canvas."""
     return canvas.to_svg_markup()
@@ -105,44 +155,43 @@ def set_canvas_size(width: int, height: int) -> str:
         width: Canvas width in mm.
         height: Canvas height in mm.
     """
-    canvas.width = width
-    canvas.height = height
-    canvas.version += 1
-    return json.dumps({"width": width, "height": height})
+    canvas.set_size(width, height)
+    return _dumps({"width": width, "height": height})
+
+
+# One screenshot round-trip at a time: they share canvas.screenshot_data/screenshot_ready
+_screenshot_lock = asyncio.Lock()
 
 
 @mcp.tool()
-def take_screenshot() -> str:
+async def take_screenshot() -> str:
     """Request a screenshot of the current SVG canvas from the browser.
-    The browser must be connected (polling) for this to work.
+    The browser must be connected (listening on /api/events) for this to work.
     Returns base64 PNG image data."""
 
-    # Set flag and clear old data
-    canvas.screenshot_data = None
-    canvas.screenshot_requested = True
+    async with _screenshot_lock:
+        # Set flag and clear old data
+        canvas.screenshot_data = None
+        canvas.screenshot_ready.clear()
+        canvas.screenshot_requested = True
+        canvas.notify()
 
-    # Poll for the browser to respond (up to 10 seconds)
-    deadline = time.time() + 10
-    while time.time() < deadline:
-        if canvas.screenshot_data is not None:
+        # Wait for the browser to respond (up to 10 seconds) off the event loop, which
+        # has to stay free to serve the browser's POST /api/screenshot
+        if await asyncio.to_thread(canvas.screenshot_ready.wait, 10):
             data = canvas.screenshot_data
             canvas.screenshot_data = None
-            return json.dumps({"screenshot": data})
-        time.sleep(0.3)
+            return _dumps({"screenshot": data})
 
-    canvas.screenshot_requested = False
-    return json.dumps({"error": "Timeout waiting for browser to capture screenshot. Is the browser connected?"})
+        canvas.screenshot_requested = False
+        return _dumps({"error": "Timeout waiting for browser to capture screenshot. Is the browser connected?"})
 
 
 @mcp.tool()
+@_cached_per_version
 def list_layers() -> str:
     """List all layers with their properties (name, color, visibility)."""
-    return json.dumps({
-        "layers": [
-            {"name": l.name, "color": l.color, "stroke_dash": l.stroke_dash, "visible": l.visible}
-            for l in canvas.layers
-        ]
-    })
+    return _dumps({"layers": canvas.layers})
 
 
 @mcp.tool()
@@ -153,12 +202,9 @@ def set_layer_visibility(layer_name: str, visible: bool) -> str:
         layer_name: Layer name (e.g. "CUT_OUTSIDE", "ENGRAVE", "NOTES").
         visible: True to show, False to hide.
     """
-    for l in canvas.layers:
-        if l.name == layer_name:
-            l.visible = visible
-            canvas.version += 1
-            return json.dumps({"layer": layer_name, "visible": visible})
-    return json.dumps({"error": f"Layer '{layer_name}' not found"})
+    if not canvas.set_layer_visibility(layer_name, visible):
+        return _dumps({"error": f"Layer '{layer_name}' not found"})
+    return _dumps({"layer": layer_name, "visible": visible})
 
 
 @mcp.tool()
@@ -169,110 +215,223 @@ def set_element_layer(element_id: str, layer_name: str) -> str:
         element_id: The element ID (e.g. "el-1").
         layer_name: Target layer name (e.g. "CUT_OUTSIDE", "CUT_INSIDE", "ENGRAVE", "NOTES").
     """
-    el = canvas.elements.get(element_id)
+    if layer_name not in canvas.layer_by_name:
+        return _dumps({"error": f"Layer '{layer_name}' not found"})
+    el = canvas.set_element_layer(element_id, layer_name)
     if not el:
-        return json.dumps({"error": f"Element '{element_id}' not found"})
-    valid_names = {l.name for l in canvas.layers}
-    if layer_name not in valid_names:
-        return json.dumps({"error": f"Layer '{layer_name}' not found"})
-    el.attrs["data-layer"] = layer_name
-    canvas.version += 1
-    return json.dumps({"id": el.id, "layer": layer_name})
+        return _dumps({"error": f"Element '{element_id}' not found"})
+    return _dumps({"id": el.id, "layer": el.layer})
 
 
 # ── HTTP Bridge ────────────────────────────────────────────
 
-@web.middleware
-async def cors_middleware(request, handler):
-    if request.method == "OPTIONS":
-        return web.Response(headers={
-            "Access-Control-Allow-Origin": "*",
-            "Access-Control-Allow-Methods": "GET, POST, OPTIONS",
-            "Access-Control-Allow-Headers": "Content-Type",
-        })
-    response = await handler(request)
-    response.headers["Access-Control-Allow-Origin"] = "*"
-    return response
-
-
-async def handle_get_svg(request):
-    """Browser polls this to get current SVG state."""
-    elements = [
-        {"id": el.id, "tag": el.tag, "attrs": el.attrs, "text_content": el.text_content}
-        for el in canvas.list_elements()
-    ]
-    layers = [
-        {"name": l.name, "color": l.color, "stroke_dash": l.stroke_dash, "visible": l.visible}
-        for l in canvas.layers
-    ]
-    return web.json_response({
-        "version": canvas.version,
-        "width": canvas.width,
-        "height": canvas.height,
+LONG_POLL_TIMEOUT = 25  # seconds a GET /api/svg?since=N is held open
+VERSION_FLUSH_DELAY = 0.01  # seconds pending element edits wait to be folded into one version bump
+SSE_KEEPALIVE_INTERVAL = 15  # seconds between comment lines on an idle /api/events stream
+
+# Long-poll and event-stream waiters park on this event; it is swapped for a fresh one on every change.
+# Only touched from the server's event loop.
+_version_changed = asyncio.Event()
+
+# Set once the HTTP bridge starts shutting down, so held long-polls and event streams end
+_shutting_down = asyncio.Event()
+
+# index.html contents, loaded once by create_http_app
+INDEX_HTML_BYTES: bytes | None = None
+
+
+def _signal_version_changed():
+    global _version_changed
+    _version_changed.set()
+    _version_changed = asyncio.Event()
+
+
+async def handle_get_svg(request: Request) -> Response:
+    """Browser long-polls this to get current SVG state.
+
+    With ``?since=N`` the request is held until the canvas moves past version N
+    (or a screenshot is requested), answering 204 if nothing happens in time.
+    """
+    try:
+        since = int(request.query_params.get("since", "-1"))
+    except ValueError:
+        since = -1
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + LONG_POLL_TIMEOUT
+    # A wakeup doesn't guarantee this poll has anything new (e.g. it arrived with a
+    # since= ahead of the canvas), so re-check and keep waiting out the remaining time
+    while canvas.version <= since and not canvas.screenshot_requested:
+        remaining = deadline - loop.time()
+        if remaining <= 0 or _shutting_down.is_set():
+            return Response(status_code=204)
+        try:
+            await asyncio.wait_for(_version_changed.wait(), timeout=remaining)
+        except asyncio.TimeoutError:
+            return Response(status_code=204)
+
+    with canvas.lock:
+        # Hand the screenshot request to a single response so the next poll parks again
+        screenshot_requested = canvas.screenshot_requested
+        canvas.screenshot_requested = False
+        cached = canvas.cached_snapshot(screenshot_requested)
+        if cached is not None:
+            return Response(cached, media_type="application/json")
+        version = canvas.current_version()
+        # Snapshot under the lock, serialize outside it. orjson walks the SvgElement and
+        # LayerInfo dataclasses itself; mutations only happen on this loop, so none can
+        # land mid-dump.
+        width, height = canvas.width, canvas.height
+        elements = canvas.list_elements()
+        layers = list(canvas.layers)
+
+    body = orjson.dumps({
+        "version": version,
+        "width": width,
+        "height": height,
         "elements": elements,
         "layers": layers,
-        "screenshot_requested": canvas.screenshot_requested,
+        "screenshot_requested": screenshot_requested,
     })
+    canvas.cache_snapshot(version, screenshot_requested, body)
+    return Response(body, media_type="application/json")
+
 
+async def handle_events(request: Request) -> Response:
+    """Server-sent events pushed to the browser.
 
-async def handle_post_svg(request):
+    ``update`` carries ``canvas.changes_since`` the last version sent on this stream (or
+    the ``?since=N`` it was opened with); ``screenshot`` asks the browser for a capture.
+    """
+    try:
+        since = int(request.query_params.get("since", "-1"))
+    except ValueError:
+        since = -1
+
+    async def stream():
+        nonlocal since
+        while not _shutting_down.is_set():
+            changed = _version_changed
+            if canvas.screenshot_requested:
+                canvas.screenshot_requested = False
+                yield b"event: screenshot\ndata: {}\n\n"
+            if canvas.version != since:
+                delta = canvas.changes_since(since)
+                since = delta["version"]
+                yield b"event: update\ndata: " + orjson.dumps(delta) + b"\n\n"
+            try:
+                await asyncio.wait_for(changed.wait(), timeout=SSE_KEEPALIVE_INTERVAL)
+            except asyncio.TimeoutError:
+                yield b": keepalive\n\n"
+
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+async def handle_post_svg(request: Request) -> Response:
     """Browser pushes its current SVG state."""
-    data = await request.json()
+    data = orjson.loads(await request.body())
     svg_markup = data.get("svg", "")
     if svg_markup:
         canvas.from_svg_markup(svg_markup)
-    return web.json_response({"version": canvas.version, "status": "ok"})
+    return ORJSONResponse({"version": canvas.version, "status": "ok"})
 
 
-async def handle_post_screenshot(request):
+async def handle_post_screenshot(request: Request) -> Response:
     """Browser posts captured screenshot data."""
-    data = await request.json()
+    data = orjson.loads(await request.body())
     png_data = data.get("image", "")
     if png_data:
         canvas.screenshot_data = png_data
         canvas.screenshot_requested = False
-    return web.json_response({"status": "ok"})
+        canvas.screenshot_ready.set()
+    return ORJSONResponse({"status": "ok"})
 
 
-async def handle_root(request):
-    """Serve index.html."""
+async def handle_root(request: Request) -> Response:
+    """Serve index.html (read once at startup)."""
+    if INDEX_HTML_BYTES is None:
+        return Response("index.html not found", status_code=404, media_type="text/plain")
+    return Response(INDEX_HTML_BYTES, media_type="text/html")
+
+
+def load_index_html() -> bytes | None:
+    """Read index.html next to this file; None if it is missing."""
     html_path = os.path.join(os.path.dirname(__file__) or ".", "index.html")
-    if not os.path.exists(html_path):
-        return web.Response(text="index.html not found", status=404)
-    with open(html_path, "r") as f:
-        html = f.read()
-    return web.Response(text=html, content_type="text/html")
-
-
-def run_http_server(port: int):
-    """Run the HTTP bridge in its own event loop on a background thread."""
-    app = web.Application(middlewares=[cors_middleware])
-    app.router.add_get("/", handle_root)
-    app.router.add_get("/api/svg", handle_get_svg)
-    app.router.add_post("/api/svg", handle_post_svg)
-    app.router.add_post("/api/screenshot", handle_post_screenshot)
-    # OPTIONS preflight for all routes
-    app.router.add_route("OPTIONS", "/api/svg", lambda r: web.Response())
-    app.router.add_route("OPTIONS", "/api/screenshot", lambda r: web.Response())
-
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    runner = web.AppRunner(app)
-    loop.run_until_complete(runner.setup())
-    site = web.TCPSite(runner, "0.0.0.0", port)
-    loop.run_until_complete(site.start())
-    log.info(f"HTTP bridge running on port {port}")
-    loop.run_forever()
+    try:
+        with open(html_path, "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        log.warning(f"index.html not found at {html_path} — GET / will return 404")
+        return None
+
+
+def create_http_app() -> Starlette:
+    """Build the HTTP bridge app the browser talks to."""
+    global INDEX_HTML_BYTES
+    INDEX_HTML_BYTES = load_index_html()
+
+    return Starlette(
+        routes=[
+            Route("/", handle_root),
+            Route("/api/svg", handle_get_svg, methods=["GET"]),
+            Route("/api/svg", handle_post_svg, methods=["POST"]),
+            Route("/api/events", handle_events, methods=["GET"]),
+            Route("/api/screenshot", handle_post_screenshot, methods=["POST"]),
+        ],
+        middleware=[
+            # Answers OPTIONS preflight for all routes
+            Middleware(
+                CORSMiddleware,
+                allow_origins=["*"],
+                allow_methods=["GET", "POST", "OPTIONS"],
+                allow_headers=["Content-Type"],
+            ),
+        ],
+    )
+
+
+class _BridgeServer(uvicorn.Server):
+    """uvicorn server that lets held long-polls and /api/events streams finish on shutdown."""
+
+    async def shutdown(self, sockets=None):
+        _shutting_down.set()
+        _signal_version_changed()
+        await super().shutdown(sockets=sockets)
+
+
+async def serve(http_port: int):
+    """Run the HTTP bridge and the MCP SSE server side by side on one event loop."""
+    loop = asyncio.get_running_loop()
+    # Wake long-poll waiters on this loop, whichever thread bumped the version
+    canvas.listeners.append(lambda: loop.call_soon_threadsafe(_signal_version_changed))
+    # Coalesce bursts of element edits into one bump/wakeup per VERSION_FLUSH_DELAY
+    canvas.flush_scheduler = lambda: loop.call_soon_threadsafe(loop.call_later, VERSION_FLUSH_DELAY, canvas.flush)
+
+    http_server = _BridgeServer(uvicorn.Config(
+        create_http_app(),
+        host="0.0.0.0",
+        port=http_port,
+        log_level="info",
+    ))
+    log.info(f"HTTP bridge running on port {http_port}")
+    log.info(f"Starting MCP server on SSE port {mcp_port}")
+    await asyncio.gather(http_server.serve(), mcp.run_sse_async())
 
 
 # ── Main ───────────────────────────────────────────────────
 
-if __name__ == "__main__":
-    port = int(os.environ.get("HTTP_PORT", "8765"))
-    mcp_port = int(os.environ.get("MCP_PORT", "8766"))
+def _interrupt(signum, frame):
+    raise KeyboardInterrupt
 
-    http_thread = threading.Thread(target=run_http_server, args=(port,), daemon=True)
-    http_thread.start()
 
-    log.info(f"Starting MCP server on SSE port {mcp_port}")
-    mcp.run(transport="sse")
+if __name__ == "__main__":
+    port = int(os.environ.get("HTTP_PORT", "8765"))
+    # uvicorn re-raises SIGTERM (docker stop) once it has shut down; the default handler would
+    # kill the process before the finally below runs, so treat it like Ctrl+C instead
+    signal.signal(signal.SIGTERM, _interrupt)
+    log_listener.start()
+    try:
+        asyncio.run(serve(port))
+    except KeyboardInterrupt:  # uvicorn re-raises Ctrl+C once both servers have shut down
+        pass
+    finally:
+        log_listener.stop()  # flushes queued records
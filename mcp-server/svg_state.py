@@ -1,12 +1,28 @@
+import sys
 import threading
-import xml.etree.ElementTree as ET
+from collections import deque
+from collections.abc import Callable
+from contextlib import AbstractContextManager
 from dataclasses import dataclass, field
 
+try:
+    from lxml import etree as ET
+
+    # Browser-pushed markup: never expand entities or reach the network
+    _XML_PARSER = ET.XMLParser(resolve_entities=False, no_network=True)
+except ImportError:  # stdlib fallback, same fromstring/ParseError surface
+    import xml.etree.ElementTree as ET
+
+    _XML_PARSER = None
+
 SVG_NS = "http://www.w3.org/2000/svg"
 SHAPE_TAGS = {"line", "rect", "circle", "ellipse", "text", "path", "polygon", "polyline"}
+DEFAULT_LAYER = "CUT_OUTSIDE"
+HISTORY_LENGTH = 64  # versions kept for changes_since(); older clients resync in full
+TOOL_CACHE_MAX_ENTRIES = 32  # cached tool results kept before the cache is cleared
 
 
-@dataclass
+@dataclass(slots=True)
 class LayerInfo:
     name: str
     color: str
@@ -22,12 +38,19 @@ DEFAULT_LAYERS = [
 ]
 
 
-@dataclass
+def _xml_escape(value: str) -> str:
+    """Escape an attribute value or text node. Chained str.replace beats str.translate in CPython."""
+    return value.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;").replace('"', "&quot;")
+
+
+@dataclass(slots=True)
 class SvgElement:
     id: str
     tag: str
     attrs: dict[str, str]
     text_content: str = ""
+    # Kept out of attrs; serialized back as the data-layer attribute
+    layer: str = DEFAULT_LAYER
 
 
 @dataclass
@@ -35,87 +58,293 @@ class SvgCanvas:
     width: int = 800
     height: int = 600
     elements: dict[str, SvgElement] = field(default_factory=dict)
-    order: list[str] = field(default_factory=list)
+    # Insertion-ordered set of element ids (values unused) — O(1) removal
+    order: dict[str, None] = field(default_factory=dict)
+    # Layer name -> ids of the elements on it, in the same document order as order
+    layer_index: dict[str, dict[str, None]] = field(default_factory=dict)
     next_id: int = 1
+    # Published to the browser. Single-element edits only mark the canvas dirty; the
+    # pending marks are folded into one bump by flush() (see mark_dirty).
     version: int = 0
+    # Ids touched by edits not yet folded into a version (values unused)
+    pending_changes: dict[str, None] = field(default_factory=dict)
+    # (version, ids changed by that bump) for recent versions; None ids = whole-canvas change
+    history: deque[tuple[int, tuple[str, ...] | None]] = field(default_factory=lambda: deque(maxlen=HISTORY_LENGTH))
     screenshot_requested: bool = False
     screenshot_data: str | None = None
+    screenshot_ready: threading.Event = field(default_factory=threading.Event)
     layers: list[LayerInfo] = field(default_factory=lambda: [LayerInfo(l.name, l.color, l.stroke_dash, l.visible) for l in DEFAULT_LAYERS])
-    lock: threading.Lock = field(default_factory=threading.Lock)
+    # Name -> LayerInfo for O(1) lookups; rebuild via _index_layers() if layers changes
+    layer_by_name: dict[str, LayerInfo] = field(init=False, repr=False)
+    # Reentrant lock guarding elements/order/size/version. Writers hold it for the whole
+    # mutation; readers only to snapshot, serializing after release. Element attrs are
+    # replaced, never mutated, so snapshots stay valid.
+    lock: AbstractContextManager = field(default_factory=threading.RLock)
+    # Called (from whichever thread mutated the canvas) after every version bump
+    listeners: list[Callable[[], None]] = field(default_factory=list)
+    # Arranges for flush() to run shortly; without one, mark_dirty flushes immediately
+    flush_scheduler: Callable[[], None] | None = None
+    # Serialized GET /api/svg body, keyed by (version, screenshot_requested)
+    _snapshot_cache: tuple[tuple[int, bool], bytes] | None = field(default=None, repr=False)
+    # Read-only MCP tool results: (tool name, *sorted kwargs) -> (version, JSON string)
+    _tool_cache: dict[tuple, tuple[int, str]] = field(default_factory=dict, repr=False)
+
+    def __post_init__(self) -> None:
+        self._index_layers()
+
+    def _index_layers(self) -> None:
+        self.layer_by_name = {l.name: l for l in self.layers}
+
+    def notify(self) -> None:
+        for listener in self.listeners:
+            listener()
+
+    def bump_version(self, changed: tuple[str, ...] | None = None) -> None:
+        """Publish a new version; ``changed`` lists the element ids it touched (None = everything)."""
+        with self.lock:
+            self.pending_changes.clear()
+            self.version += 1
+            self.history.append((self.version, changed))
+            self.notify()
+
+    def mark_dirty(self, element_id: str) -> None:
+        """Record an element change whose version bump may be coalesced with others."""
+        with self.lock:
+            flush_scheduled = bool(self.pending_changes)
+            self.pending_changes[element_id] = None
+            if flush_scheduled:
+                return
+        if self.flush_scheduler is None:
+            self.flush()
+        else:
+            self.flush_scheduler()
+
+    def flush(self) -> None:
+        """Fold pending changes into a single version bump."""
+        with self.lock:
+            if self.pending_changes:
+                self.bump_version(tuple(self.pending_changes))
+
+    def current_version(self) -> int:
+        """Version including any pending changes — use this to key caches.
+
+        It flushes, so don't poll it to decide whether to notify clients; compare the
+        published ``version`` there, or the flush window never gets to batch anything.
+        """
+        with self.lock:
+            self.flush()
+            return self.version
+
+    # Cached serializations are tagged with the version they were built at and only
+    # served while current_version() still matches, so any mutation invalidates them.
+
+    def cached_tool_result(self, key: tuple) -> str | None:
+        """Result cached for ``key`` at the current version, if any."""
+        with self.lock:
+            hit = self._tool_cache.get(key)
+            if hit is not None and hit[0] == self.current_version():
+                return hit[1]
+            return None
+
+    def cache_tool_result(self, key: tuple, version: int, result: str) -> None:
+        """Remember ``result`` for ``key`` as built at ``version``."""
+        with self.lock:
+            if len(self._tool_cache) >= TOOL_CACHE_MAX_ENTRIES:
+                self._tool_cache.clear()
+            self._tool_cache[key] = (version, result)
+
+    def cached_snapshot(self, screenshot_requested: bool) -> bytes | None:
+        """GET /api/svg body cached for the current version, if any."""
+        with self.lock:
+            cache = self._snapshot_cache
+            if cache is not None and cache[0] == (self.current_version(), screenshot_requested):
+                return cache[1]
+            return None
+
+    def cache_snapshot(self, version: int, screenshot_requested: bool, body: bytes) -> None:
+        """Remember the GET /api/svg body built at ``version``."""
+        with self.lock:
+            self._snapshot_cache = ((version, screenshot_requested), body)
+
+    def changes_since(self, since: int) -> dict:
+        """Element delta from version ``since`` to the published ``version``.
+
+        Pending edits are left out; their flush publishes them and wakes listeners.
+
+        Returns ``{"version", "base", "elements", "removed"}`` where ``elements`` holds the
+        changed/added elements in the order they were touched. When the history no longer
+        reaches back to ``since`` or a whole-canvas change happened in between, returns
+        ``{"version", "base", "full": True}`` and the caller should fetch the full state.
+        """
+        with self.lock:
+            full = {"version": self.version, "base": since, "full": True}
+            if not 0 <= since <= self.version or not self.history or self.history[0][0] > since + 1:
+                return full
+            ids: dict[str, None] = {}
+            for version, changed in self.history:
+                if version <= since:
+                    continue
+                if changed is None:
+                    return full
+                ids.update(dict.fromkeys(changed))
+            return {
+                "version": self.version,
+                "base": since,
+                "elements": [self.elements[eid] for eid in ids if eid in self.elements],
+                "removed": [eid for eid in ids if eid not in self.elements],
+            }
 
     def _new_id(self) -> str:
         eid = f"el-{self.next_id}"
         self.next_id += 1
         return eid
 
-    def add_element(self, tag: str, attrs: dict[str, str], text_content: str = "") -> SvgElement:
-        eid = self._new_id()
-        el = SvgElement(id=eid, tag=tag, attrs=dict(attrs), text_content=text_content)
-        self.elements[eid] = el
-        self.order.append(eid)
-        self.version += 1
+    def add_element(
+        self, tag: str, attrs: dict[str, str], text_content: str = "", layer: str | None = None, copy: bool = False
+    ) -> SvgElement:
+        """Add an element; ``layer`` wins over a data-layer attribute, which wins over the default.
+
+        The element takes ownership of ``attrs`` (its data-layer key is popped); pass
+        ``copy=True`` to keep using the dict afterwards.
+        """
+        if copy:
+            attrs = dict(attrs)
+        attr_layer = attrs.pop("data-layer", None)
+        layer = sys.intern(layer or attr_layer or DEFAULT_LAYER)
+        with self.lock:
+            eid = self._new_id()
+            el = SvgElement(id=eid, tag=sys.intern(tag), attrs=attrs, text_content=text_content, layer=layer)
+            self.elements[eid] = el
+            self.order[eid] = None
+            self.layer_index.setdefault(layer, {})[eid] = None
+            self.mark_dirty(eid)
         return el
 
     def update_element(self, element_id: str, attrs: dict[str, str]) -> SvgElement | None:
-        el = self.elements.get(element_id)
-        if not el:
-            return None
-        el.attrs.update(attrs)
-        self.version += 1
+        """Merge attrs into an element; a data-layer attribute moves it to that layer."""
+        with self.lock:
+            el = self.elements.get(element_id)
+            if not el:
+                return None
+            merged = {**el.attrs, **attrs}
+            layer = merged.pop("data-layer", None)
+            el.attrs = merged
+            if layer is not None:
+                self._move_to_layer(el, layer)
+            self.mark_dirty(element_id)
+        return el
+
+    def set_element_layer(self, element_id: str, layer_name: str) -> SvgElement | None:
+        with self.lock:
+            el = self.elements.get(element_id)
+            if not el:
+                return None
+            self._move_to_layer(el, layer_name)
+            self.mark_dirty(element_id)
         return el
 
+    def _move_to_layer(self, el: SvgElement, layer_name: str) -> None:
+        if el.layer == layer_name:
+            return
+        self.layer_index[el.layer].pop(el.id, None)
+        el.layer = sys.intern(layer_name)
+        members = self.layer_index.setdefault(el.layer, {})
+        members[el.id] = None
+        # Appending would put el last whatever its z-position; re-sort the layer by document order
+        if len(members) > 1:
+            self.layer_index[el.layer] = {eid: None for eid in self.order if eid in members}
+
     def remove_element(self, element_id: str) -> bool:
-        if element_id not in self.elements:
-            return False
-        del self.elements[element_id]
-        self.order = [eid for eid in self.order if eid != element_id]
-        self.version += 1
+        with self.lock:
+            if element_id not in self.elements:
+                return False
+            el = self.elements.pop(element_id)
+            del self.order[element_id]
+            del self.layer_index[el.layer][element_id]
+            self.mark_dirty(element_id)
+        return True
+
+    def set_size(self, width: int, height: int) -> None:
+        with self.lock:
+            self.width = width
+            self.height = height
+            self.bump_version()
+
+    def set_layer_visibility(self, layer_name: str, visible: bool) -> bool:
+        with self.lock:
+            layer = self.layer_by_name.get(layer_name)
+            if layer is None:
+                return False
+            layer.visible = visible
+            self.bump_version()
         return True
 
     def list_elements(self) -> list[SvgElement]:
-        return [self.elements[eid] for eid in self.order if eid in self.elements]
+        with self.lock:
+            return [self.elements[eid] for eid in self.order]
+
+    def elements_in_layer(self, layer_name: str) -> list[SvgElement]:
+        """Elements on one layer in document order — O(k) in the layer size via layer_index."""
+        with self.lock:
+            return [self.elements[eid] for eid in self.layer_index.get(layer_name, ())]
 
     def get_element(self, element_id: str) -> SvgElement | None:
         return self.elements.get(element_id)
 
     def to_svg_markup(self) -> str:
-        parts = [f'<svg xmlns="{SVG_NS}" width="{self.width}" height="{self.height}">']
-        for el in self.list_elements():
-            attr_str = " ".join(f'{k}="{v}"' for k, v in el.attrs.items())
+        with self.lock:
+            width, height = self.width, self.height
+            elements = self.list_elements()
+        # One flat list of fragments joined once — no per-attribute or per-element f-strings
+        parts = [f'<svg xmlns="{SVG_NS}" width="{width}" height="{height}">']
+        extend = parts.extend
+        esc = _xml_escape
+        for el in elements:
+            extend(("\n  <", el.tag, ' id="', esc(el.id), '" data-layer="', esc(el.layer), '"'))
+            for k, v in el.attrs.items():
+                extend((" ", k, '="', esc(v), '"'))
             if el.tag == "text":
-                parts.append(f"  <text id=\"{el.id}\" {attr_str}>{el.text_content}</text>")
+                extend((">", esc(el.text_content), "</text>"))
             else:
-                parts.append(f"  <{el.tag} id=\"{el.id}\" {attr_str}/>")
-        parts.append("</svg>")
-        return "\n".join(parts)
+                parts.append("/>")
+        parts.append("\n</svg>")
+        return "".join(parts)
 
     def from_svg_markup(self, markup: str) -> None:
+        """Replace the canvas contents with the parsed markup as a single version bump.
+
+        Parsing happens outside the lock; the new state is swapped in under it.
+        """
         try:
-            root = ET.fromstring(markup)
+            root = ET.fromstring(markup.encode(), _XML_PARSER)
         except ET.ParseError:
             return
 
-        # Update canvas size from root attributes
+        # Canvas size from root attributes
+        width = height = None
         w = root.get("width")
         h = root.get("height")
         if w:
             try:
-                self.width = int(float(w))
+                width = int(float(w))
             except ValueError:
                 pass
         if h:
             try:
-                self.height = int(float(h))
+                height = int(float(h))
             except ValueError:
                 pass
 
-        self.elements.clear()
-        self.order.clear()
+        elements: dict[str, SvgElement] = {}
+        order: dict[str, None] = {}
+        layer_index: dict[str, dict[str, None]] = {}
 
         max_id = 0
         for child in root:
             # Strip namespace prefix if present
             tag = child.tag
+            if not isinstance(tag, str):  # lxml yields comments / PIs as children
+                continue
             if "}" in tag:
                 tag = tag.split("}", 1)[1]
 
@@ -135,13 +364,17 @@ class SvgCanvas:
                     pass
 
             attrs = {}
+            layer = DEFAULT_LAYER
             for k, v in child.attrib.items():
                 if k == "id":
                     continue
                 # Strip namespace prefixes from attribute names
                 if "}" in k:
                     k = k.split("}", 1)[1]
-                attrs[k] = v
+                if k == "data-layer":
+                    layer = sys.intern(v)
+                    continue
+                attrs[sys.intern(k)] = v
 
             text_content = child.text or "" if tag == "text" else ""
 
@@ -149,9 +382,21 @@ class SvgCanvas:
                 el_id = f"el-{max_id + 1}"
                 max_id += 1
 
-            el = SvgElement(id=el_id, tag=tag, attrs=attrs, text_content=text_content)
-            self.elements[el_id] = el
-            self.order.append(el_id)
+            # A duplicate id replaces the earlier element but keeps its position in order
+            el = SvgElement(id=el_id, tag=sys.intern(tag), attrs=attrs, text_content=text_content, layer=layer)
+            elements[el_id] = el
+            order[el_id] = None
+
+        for el_id in order:
+            layer_index.setdefault(elements[el_id].layer, {})[el_id] = None
 
-        self.next_id = max_id + 1
-        self.version += 1
+        with self.lock:
+            if width is not None:
+                self.width = width
+            if height is not None:
+                self.height = height
+            self.elements = elements
+            self.order = order
+            self.layer_index = layer_index
+            self.next_id = max_id + 1
+            self.bump_version()